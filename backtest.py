@@ -1,24 +1,40 @@
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple, Union
+from functools import lru_cache
 import logging
 
 import numpy as np
 import pandas as pd
 
-from utils import get_logger, align_to_trading_days
+from utils import get_logger, align_to_trading_days, njit
 
+try:
+    import bottleneck as bn
+except Exception:  # bottleneck 为可选依赖；缺失时回退到 pandas rolling
+    bn = None
 
-def _prepare_price_frame(price_map: Dict[str, pd.DataFrame]) -> pd.DataFrame:
-    series = []
-    names = []
+
+def _prepare_price_frame(price_map: Union[pd.DataFrame, Dict[str, pd.DataFrame]]) -> pd.DataFrame:
+    if isinstance(price_map, pd.DataFrame):
+        # 已是宽表（日期索引 × 资产代码列），只需统一对齐与填充
+        prices = align_to_trading_days(price_map.astype(np.float64))
+        return prices.ffill().dropna(how="all")
+    # 先拼成长表（日期, 代码, 收盘价），一次透视为宽表，避免逐资产对齐后再多路合并
+    frames = []
     for code, df in price_map.items():
-        df = align_to_trading_days(df)
         close_col = "close" if "close" in df.columns else "收盘价"
-        s = df[close_col].astype(float).rename(code)
-        series.append(s)
-        names.append(code)
-    prices = pd.concat(series, axis=1).sort_index()
+        frames.append(pd.DataFrame({
+            "trade_date": df["trade_date"].to_numpy() if "trade_date" in df.columns else df.index.to_numpy(),
+            "code": code,
+            "close": df[close_col].to_numpy(dtype=np.float64),
+        }))
+    long = pd.concat(frames, ignore_index=True)
+    long["trade_date"] = pd.to_datetime(long["trade_date"])
+    prices = long.pivot_table(index="trade_date", columns="code", values="close", aggfunc="first")
+    prices = prices.reindex(columns=list(price_map))
+    prices.columns.name = None
+    prices = align_to_trading_days(prices)
     prices = prices.ffill().dropna(how="all")
-    return prices
+    return prices.astype(np.float64, copy=False)
 
 
 def _normalize_freq(freq: str):
@@ -28,55 +44,255 @@ def _normalize_freq(freq: str):
     return f if f in {"M", "Q", "A", "Y", "W", "D"} else None
 
 
+def _daily_returns(P: np.ndarray) -> np.ndarray:
+    """逐日收益率矩阵：首日为0；前值缺失或为0、或当日价格缺失时记为0。"""
+    R = np.zeros_like(P, dtype=np.float64)
+    prev, cur = P[:-1], P[1:]
+    valid = (prev != 0) & ~np.isnan(prev)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        R[1:] = np.where(valid, (cur - prev) / np.where(valid, prev, 1.0), 0.0)
+    return np.nan_to_num(R, nan=0.0)
+
+
+def _rolling_max(arr: np.ndarray, window: int) -> np.ndarray:
+    """按列滚动最大值；前 window-1 行及窗口内含缺失值时为 NaN（与 pandas rolling 一致）。"""
+    window = int(window)
+    if bn is None:
+        return pd.DataFrame(arr).rolling(window).max().to_numpy(dtype=np.float64)
+    if window > len(arr):
+        return np.full(arr.shape, np.nan)
+    return bn.move_max(arr, window=window, axis=0)
+
+
+def _holdings_to_frames(prices: pd.DataFrame, H: np.ndarray) -> Tuple[pd.Series, pd.Series, pd.DataFrame]:
+    """由逐日分资产市值矩阵 H (T×N) 直接构造组合净值、日收益与分资产市值。"""
+    pv = H.sum(axis=1)
+    ret = np.zeros_like(pv)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret[1:] = pv[1:] / pv[:-1] - 1.0
+    pf = pd.Series(pv, index=prices.index)
+    daily_ret = pd.Series(np.nan_to_num(ret, nan=0.0), index=prices.index)
+    asset_df = pd.DataFrame(H, index=prices.index, columns=prices.columns)
+    return pf, daily_ret, asset_df
+
+
 def _simulate_rebalanced_portfolio(prices: pd.DataFrame, weights: Dict[str, float], freq: str = "M") -> Tuple[pd.Series, pd.Series, pd.DataFrame, pd.DataFrame]:
-    start_val = 1.0
     norm_freq = _normalize_freq(freq)
     rebal_dates = prices.resample(norm_freq).first().index if norm_freq else pd.DatetimeIndex([])
 
-    holding_value = {c: start_val * weights.get(c, 0.0) for c in prices.columns}
-
-    portfolio_values = []
-    per_asset_values = []
-    events_rows = []
-    prev_prices = prices.iloc[0]
-
-    for dt, row in prices.iterrows():
-        if norm_freq and dt in rebal_dates:
-            total_val = sum(holding_value.values())
-            for c in prices.columns:
-                holding_value[c] = total_val * weights.get(c, 0.0)
-            for c in prices.columns:
-                events_rows.append({
-                    "date": dt,
-                    "event": "fixed_rebalance",
-                    "asset": c,
-                    "new_weight": float(weights.get(c, 0.0)),
-                    "factor": 1.0,
-                    "reason": str(norm_freq)
-                })
-
-        for c in prices.columns:
-            if prev_prices[c] == 0 or np.isnan(prev_prices[c]):
-                ret = 0.0
-            else:
-                ret = (row[c] - prev_prices[c]) / prev_prices[c]
-            holding_value[c] *= (1.0 + (ret if not np.isnan(ret) else 0.0))
-
-        total_val = sum(holding_value.values())
-        portfolio_values.append((dt, total_val))
-        per_asset_values.append((dt, {c: holding_value[c] for c in prices.columns}))
-        prev_prices = row
-
-    pf = pd.Series({dt: v for dt, v in portfolio_values}).sort_index()
-    asset_df = pd.DataFrame({dt: vals for dt, vals in per_asset_values}).T
-    asset_df.index = pf.index
-    daily_ret = pf.pct_change().fillna(0.0)
-    events_df = pd.DataFrame(events_rows)
+    cols = prices.columns
+    P = prices.to_numpy(dtype=np.float64)
+    n_rows, n_assets = P.shape
+    w = np.array([weights.get(c, 0.0) for c in cols], dtype=np.float64)
+    R = _daily_returns(P)
+
+    # 以再平衡日切分区间，区间内持仓按累计收益整体推进
+    is_rebal = prices.index.isin(rebal_dates)
+    bounds = np.union1d([0, n_rows], np.flatnonzero(is_rebal))
+    H = np.empty((n_rows, n_assets), dtype=np.float64)
+    holding = w.copy()
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        if is_rebal[a]:
+            holding = holding.sum() * w
+        H[a:b] = holding * np.cumprod(1.0 + R[a:b], axis=0)
+        holding = H[b - 1]
+
+    pf, daily_ret, asset_df = _holdings_to_frames(prices, H)
+
+    rb_dates = prices.index[is_rebal]
+    events_df = pd.DataFrame({
+        "date": np.repeat(rb_dates.values, n_assets),
+        "event": "fixed_rebalance",
+        "asset": np.tile(cols.values, len(rb_dates)),
+        "new_weight": np.tile(w, len(rb_dates)),
+        "factor": 1.0,
+        "reason": str(norm_freq),
+    })
     return pf, daily_ret, asset_df, events_df
 
 
-def _simulate_tvalue_portfolio(prices: pd.DataFrame, weights: Dict[str, float], sma_short: int = 50, sma_mid: int = 100, sma_long: int = 200, confirm_days: int = 5, cooldown_days: int = 10) -> Tuple[pd.Series, pd.Series, pd.DataFrame, pd.DataFrame]:
-    start_val = 1.0
+# 调仓原因编码（与 _TVALUE_REASONS 下标对应）
+_REASON_NONE, _REASON_EMERGENCY, _REASON_DOWN, _REASON_CONFIRM, _REASON_FAST_UP, _REASON_FAST_DOWN = range(6)
+_TVALUE_REASONS = np.array(["", "emergency_cut", "down_cross", "confirm", "fast_up", "fast_down"], dtype=object)
+
+
+@lru_cache(maxsize=None)
+def _make_tvalue_kernel(n_eq: int, has_cash: bool, has_bond: bool, cooldown_days: int):
+    """按权益资产数、有无现金/长债及冷却期生成专用 T-Value 内核。
+
+    这些参数在一次回测内固定，作为闭包常量参与编译：现金/长债分支被常量折叠，
+    权益资产维度（通常3-5只）的内层循环可被完全展开。
+    """
+
+    def _tvalue_kernel(R, P_eq, S50, S100, S200, RMAX20, R10, TIER, stable, day_no, w, eq_idx, cash_idx, bond_idx):
+        """T-Value 逐日状态机（纯数值实现，可由 numba 编译）。
+
+        返回每日分资产市值 H 以及调仓事件缓冲区（仅前 n_ev 行有效）。
+        """
+        n_rows, n_assets = R.shape
+        tier_map = np.array([0.0, 0.5, 1.0, 2.0])
+
+        holding = w.copy()
+        H = np.empty((n_rows, n_assets))
+        factors = np.ones(n_eq)
+        last_change = np.full(n_eq, -1, dtype=np.int64)
+
+        ev_day = np.empty(n_rows, dtype=np.int64)
+        ev_weight = np.empty((n_rows, n_assets))
+        ev_factor = np.empty((n_rows, n_eq))
+        ev_reason = np.zeros((n_rows, n_eq), dtype=np.int8)
+        ev_prev_tier = np.empty((n_rows, n_eq), dtype=np.int8)
+        ev_new_tier = np.empty((n_rows, n_eq), dtype=np.int8)
+        ev_dd = np.zeros((n_rows, n_eq))
+        ev_cooldown = np.zeros((n_rows, n_eq), dtype=np.bool_)
+        n_ev = 0
+
+        reason = np.zeros(n_eq, dtype=np.int8)
+        prev_tier = np.zeros(n_eq, dtype=np.int8)
+        new_tier_arr = np.zeros(n_eq, dtype=np.int8)
+        dd_val = np.zeros(n_eq)
+
+        w_cash = w[cash_idx] if has_cash else 0.0
+        w_bond = w[bond_idx] if has_bond else 0.0
+        base_eq_sum = 0.0
+        for j in range(n_eq):
+            base_eq_sum += w[eq_idx[j]]
+
+        for i in range(n_rows):
+            changed = False
+            reason[:] = _REASON_NONE
+            for j in range(n_eq):
+                p = P_eq[i, j]
+                if np.isnan(S50[i, j]) or np.isnan(S100[i, j]) or np.isnan(S200[i, j]):
+                    continue
+                target_tier = TIER[i, j]
+                conf = stable[i, j]
+
+                cooldown = last_change[j] >= 0 and day_no[i] - day_no[last_change[j]] < cooldown_days
+
+                desired_factor = tier_map[target_tier]
+                cur_factor = factors[j]
+                cur_tier = int(cur_factor > 0.0) + int(cur_factor >= 0.75) + int(cur_factor >= 1.5)
+
+                # === 紧急熔断机制：高位回撤检测 (V型顶保护) ===
+                # 逻辑：如果当前价格较过去20日最高价下跌超过 5%，且当前仓位较重(Tier>=2)，强制减仓
+                # 特点：无视 cooldown，无视均线支撑，优先逃命
+                rmax = RMAX20[i, j]
+                if not np.isnan(rmax) and rmax > 0:
+                    dd_from_peak = (p / rmax) - 1.0
+                    if dd_from_peak <= -0.05 and cur_tier >= 2:
+                        # 强制降级到 Tier 1 (0.5倍)，保住大部分利润
+                        new_factor = tier_map[1]
+                        if new_factor != cur_factor:
+                            factors[j] = new_factor
+                            last_change[j] = i
+                            changed = True
+                            reason[j] = _REASON_EMERGENCY
+                            dd_val[j] = dd_from_peak
+                            prev_tier[j] = cur_tier
+                            new_tier_arr[j] = 1
+                            continue  # 已触发熔断，跳过后续普通逻辑
+
+                # 普通逻辑
+                if not cooldown and (target_tier < cur_tier) and desired_factor != cur_factor:
+                    new_tier = max(target_tier, cur_tier - 1)
+                    factors[j] = tier_map[new_tier]
+                    last_change[j] = i
+                    changed = True
+                    reason[j] = _REASON_DOWN
+                    prev_tier[j] = cur_tier
+                    new_tier_arr[j] = new_tier
+                elif not cooldown and conf and desired_factor != cur_factor:
+                    factors[j] = desired_factor
+                    last_change[j] = i
+                    changed = True
+                    reason[j] = _REASON_CONFIRM
+                    prev_tier[j] = cur_tier
+                    new_tier_arr[j] = target_tier
+                else:
+                    r10 = R10[i, j]
+                    if not cooldown and not np.isnan(r10):
+                        if r10 >= 0.06 and cur_tier < 3:
+                            new_tier = min(3, cur_tier + 1)
+                            new_factor = tier_map[new_tier]
+                            if new_factor != cur_factor:
+                                factors[j] = new_factor
+                                last_change[j] = i
+                                changed = True
+                                reason[j] = _REASON_FAST_UP
+                                prev_tier[j] = cur_tier
+                                new_tier_arr[j] = new_tier
+                        elif r10 <= -0.06 and cur_tier > 0:
+                            new_tier = max(0, cur_tier - 1)
+                            new_factor = tier_map[new_tier]
+                            if new_factor != cur_factor:
+                                factors[j] = new_factor
+                                last_change[j] = i
+                                changed = True
+                                reason[j] = _REASON_FAST_DOWN
+                                prev_tier[j] = cur_tier
+                                new_tier_arr[j] = new_tier
+
+            if changed:
+                total_val = 0.0
+                for k in range(n_assets):
+                    total_val += holding[k]
+                new_w = np.zeros(n_assets)
+                sum_eq = 0.0
+                for j in range(n_eq):
+                    v = w[eq_idx[j]] * factors[j]
+                    new_w[eq_idx[j]] = v
+                    sum_eq += v
+                delta = sum_eq - base_eq_sum
+                target_cb = max(0.0, 1.0 - sum_eq)
+                if delta >= 0.0:
+                    reduce_cash = min(w_cash, delta)
+                    cash_new = max(0.0, w_cash - reduce_cash)
+                    bond_new = max(0.0, target_cb - cash_new)
+                else:
+                    release = -delta
+                    cash_new = min(target_cb, w_cash + release)
+                    bond_new = max(0.0, target_cb - cash_new)
+                if has_cash:
+                    new_w[cash_idx] = cash_new
+                if has_bond:
+                    new_w[bond_idx] = bond_new
+                sumb = 0.0
+                for k in range(n_assets):
+                    sumb += new_w[k]
+                if sumb > 0:
+                    for k in range(n_assets):
+                        new_w[k] = new_w[k] / sumb
+                for k in range(n_assets):
+                    holding[k] = total_val * new_w[k]
+
+                ev_day[n_ev] = i
+                ev_weight[n_ev] = new_w
+                for j in range(n_eq):
+                    f = factors[j]
+                    ev_factor[n_ev, j] = f
+                    ev_reason[n_ev, j] = reason[j]
+                    if reason[j] == _REASON_NONE:
+                        cur = int(f > 0.0) + int(f >= 0.75) + int(f >= 1.5)
+                        ev_prev_tier[n_ev, j] = cur
+                        ev_new_tier[n_ev, j] = cur
+                    else:
+                        ev_prev_tier[n_ev, j] = prev_tier[j]
+                        ev_new_tier[n_ev, j] = new_tier_arr[j]
+                    ev_dd[n_ev, j] = dd_val[j]
+                    ev_cooldown[n_ev, j] = last_change[j] >= 0 and day_no[i] - day_no[last_change[j]] < 10
+                n_ev += 1
+
+            for k in range(n_assets):
+                holding[k] *= 1.0 + R[i, k]
+            H[i] = holding
+
+        return H, n_ev, ev_day, ev_weight, ev_factor, ev_reason, ev_prev_tier, ev_new_tier, ev_dd, ev_cooldown
+
+    return njit(cache=True)(_tvalue_kernel)
+
+
+def _simulate_tvalue_portfolio(prices: pd.DataFrame, weights: Dict[str, float], sma_short: int = 50, sma_mid: int = 100, sma_long: int = 200, confirm_days: int = 5, cooldown_days: int = 10, sma_cache: Optional[Dict[int, np.ndarray]] = None) -> Tuple[pd.Series, pd.Series, pd.DataFrame, pd.DataFrame]:
     codes = list(prices.columns)
     cash_code = None
     bond_code = None
@@ -86,203 +302,80 @@ def _simulate_tvalue_portfolio(prices: pd.DataFrame, weights: Dict[str, float],
         if "511010" in c:
             bond_code = c
     equity_like = [c for c in codes if c not in {cash_code, bond_code}]
-
-    holding_value = {c: start_val * weights.get(c, 0.0) for c in prices.columns}
-    portfolio_values = []
-    per_asset_values = []
-    events_rows = []
-
-    factors = {c: 1.0 for c in equity_like}
-    last_change = {c: None for c in equity_like}
-
-    sma50 = prices[equity_like].rolling(int(sma_short)).mean()
-    sma100 = prices[equity_like].rolling(int(sma_mid)).mean()
-    sma200 = prices[equity_like].rolling(int(sma_long)).mean()
+    eq_idx = np.array([codes.index(c) for c in equity_like], dtype=np.int64)
+    cash_idx = codes.index(cash_code) if cash_code else -1
+    bond_idx = codes.index(bond_code) if bond_code else -1
+
+    P = prices.to_numpy(dtype=np.float64)
+    w = np.array([weights.get(c, 0.0) for c in codes], dtype=np.float64)
+    # 冷却期按自然日计算，故保留每行的日序号
+    day_no = prices.index.values.astype("datetime64[D]").astype(np.int64)
+
+    # 指标统一转为 float64 数组，循环内按 [行, 列] 整数位置访问
+    P_eq = prices[equity_like].to_numpy(dtype=np.float64)
+    # 均线保留 pandas rolling：其补偿求和在“价格=均线”的平局上更稳定（价格仅三位小数，平局常见）
+    windows = (int(sma_short), int(sma_mid), int(sma_long))
+    if sma_cache is not None and all(win in sma_cache for win in windows):
+        S50, S100, S200 = (sma_cache[win][:, eq_idx] for win in windows)
+    else:
+        eq_frame = pd.DataFrame(P_eq)
+        S50, S100, S200 = (eq_frame.rolling(win).mean().to_numpy(dtype=np.float64) for win in windows)
     # 增加：计算20日滚动最高价，用于检测高位回撤（V型顶）
-    roll_max20 = prices[equity_like].rolling(20).max()
-    ret10 = prices[equity_like] / prices[equity_like].shift(10) - 1.0
-
-    tier_map = {0: 0.0, 1: 0.5, 2: 1.0, 3: 2.0}
-
-    def tier_from_factor(f):
-        if f >= 1.5:
-            return 3
-        if f >= 0.75:
-            return 2
-        if f > 0.0:
-            return 1
-        return 0
-
-    prev_prices = prices.iloc[0]
-
-    for dt, row in prices.iterrows():
-        changed = False
-        asset_reason = {}
-        asset_prev_tier = {}
-        asset_new_tier = {}
-        for c in equity_like:
-            p = row[c]
-            s50 = sma50.loc[dt, c]
-            s100 = sma100.loc[dt, c]
-            s200 = sma200.loc[dt, c]
-            if np.isnan(s50) or np.isnan(s100) or np.isnan(s200):
-                continue
-            t_val = int((p > s50)) + int((p > s100)) + int((p > s200))
-            target_tier = t_val
-            conf = False
-            pos = prices.index.get_loc(dt)
-            if isinstance(pos, int) and pos >= int(confirm_days) - 1:
-                idxs = prices.index[pos - (int(confirm_days) - 1) : pos + 1]
-                vals = []
-                for ix in idxs:
-                    pv = int((prices.loc[ix, c] > sma50.loc[ix, c])) + int((prices.loc[ix, c] > sma100.loc[ix, c])) + int((prices.loc[ix, c] > sma200.loc[ix, c]))
-                    vals.append(pv)
-                if len(set(vals)) == 1 and vals[-1] == target_tier:
-                    conf = True
-
-            cooldown = False
-            if last_change[c] is not None:
-                cooldown = (dt - last_change[c]).days < int(cooldown_days)
-
-            desired_factor = tier_map.get(target_tier, 1.0)
-            cur_factor = factors[c]
-            cur_tier = tier_from_factor(cur_factor)
-
-            # === 紧急熔断机制：高位回撤检测 (V型顶保护) ===
-            # 逻辑：如果当前价格较过去20日最高价下跌超过 5%，且当前仓位较重(Tier>=2)，强制减仓
-            # 特点：无视 cooldown，无视均线支撑，优先逃命
-            rmax = roll_max20.loc[dt, c]
-            is_emergency_cut = False
-            if not np.isnan(rmax) and rmax > 0:
-                dd_from_peak = (p / rmax) - 1.0
-                if dd_from_peak <= -0.05 and cur_tier >= 2:
-                    # 强制降级到 Tier 1 (0.5倍)，保住大部分利润
-                    new_tier = 1
-                    new_factor = tier_map[new_tier]
-                    if new_factor != cur_factor:
-                        factors[c] = new_factor
-                        last_change[c] = dt
-                        changed = True
-                        asset_reason[c] = f"emergency_cut_dd{dd_from_peak:.1%}"
-                        asset_prev_tier[c] = cur_tier
-                        asset_new_tier[c] = new_tier
-                        is_emergency_cut = True
-            
-            if is_emergency_cut:
-                continue # 已触发熔断，跳过后续普通逻辑
-
-            # 普通逻辑
-            if not cooldown and (target_tier < cur_tier) and desired_factor != cur_factor:
-                new_tier = max(target_tier, cur_tier - 1)
-                new_factor = tier_map[new_tier]
-                factors[c] = new_factor
-                last_change[c] = dt
-                changed = True
-                asset_reason[c] = "down_cross"
-                asset_prev_tier[c] = cur_tier
-                asset_new_tier[c] = new_tier
-            elif not cooldown and conf and desired_factor != cur_factor:
-                factors[c] = desired_factor
-                last_change[c] = dt
-                changed = True
-                asset_reason[c] = "confirm"
-                asset_prev_tier[c] = cur_tier
-                asset_new_tier[c] = target_tier
-            else:
-                r10 = ret10.loc[dt, c]
-                if not cooldown and not np.isnan(r10):
-                    if r10 >= 0.06 and cur_tier < 3:
-                        new_tier = min(3, cur_tier + 1)
-                        new_factor = tier_map[new_tier]
-                        if new_factor != cur_factor:
-                            factors[c] = new_factor
-                            last_change[c] = dt
-                            changed = True
-                            asset_reason[c] = "fast_up"
-                            asset_prev_tier[c] = cur_tier
-                            asset_new_tier[c] = new_tier
-                    elif r10 <= -0.06 and cur_tier > 0:
-                        new_tier = max(0, cur_tier - 1)
-                        new_factor = tier_map[new_tier]
-                        if new_factor != cur_factor:
-                            factors[c] = new_factor
-                            last_change[c] = dt
-                            changed = True
-                            asset_reason[c] = "fast_down"
-                            asset_prev_tier[c] = cur_tier
-                            asset_new_tier[c] = new_tier
-
-        if changed:
-            total_val = sum(holding_value.values())
-            eq_new = {c: weights.get(c, 0.0) * factors[c] for c in equity_like}
-            sum_eq = float(sum(eq_new.values()))
-            w_cash = weights.get(cash_code, 0.0) if cash_code else 0.0
-            w_bond = weights.get(bond_code, 0.0) if bond_code else 0.0
-            base_eq_sum = float(sum(weights.get(c, 0.0) for c in equity_like))
-            delta = sum_eq - base_eq_sum
-            target_cb = max(0.0, 1.0 - sum_eq)
-            if delta >= 0.0:
-                reduce_cash = min(w_cash, delta)
-                cash_new = max(0.0, w_cash - reduce_cash)
-                bond_new = max(0.0, target_cb - cash_new)
-            else:
-                release = -delta
-                cash_new = min(target_cb, w_cash + release)
-                bond_new = max(0.0, target_cb - cash_new)
-
-            new_w = {c: 0.0 for c in prices.columns}
-            for k, v in eq_new.items():
-                new_w[k] = v
-            if cash_code:
-                new_w[cash_code] = cash_new
-            if bond_code:
-                new_w[bond_code] = bond_new
-            sumb = float(sum(new_w.values()))
-            if sumb > 0:
-                for k in new_w:
-                    new_w[k] = new_w[k] / sumb
-            for c in prices.columns:
-                holding_value[c] = total_val * new_w.get(c, 0.0)
-            for c in prices.columns:
-                s50 = sma50.loc[dt, c] if c in sma50.columns else np.nan
-                s100 = sma100.loc[dt, c] if c in sma100.columns else np.nan
-                s200 = sma200.loc[dt, c] if c in sma200.columns else np.nan
-                r10 = ret10.loc[dt, c] if c in ret10.columns else np.nan
-                events_rows.append({
-                    "date": dt,
-                    "event": "tvalue_rebalance",
-                    "asset": c,
-                    "new_weight": float(new_w.get(c, 0.0)),
-                    "factor": float(factors.get(c, 1.0)) if c in equity_like else 1.0,
-                    "reason": asset_reason.get(c, ""),
-                    "prev_tier": int(asset_prev_tier.get(c, tier_from_factor(factors.get(c, 1.0)))),
-                    "new_tier": int(asset_new_tier.get(c, tier_from_factor(factors.get(c, 1.0)))),
-                    "price": float(row[c]),
-                    "sma50": float(s50) if not np.isnan(s50) else None,
-                    "sma100": float(s100) if not np.isnan(s100) else None,
-                    "sma200": float(s200) if not np.isnan(s200) else None,
-                    "ret10": float(r10) if not np.isnan(r10) else None,
-                    "cooldown": bool(last_change.get(c) is not None and (dt - last_change[c]).days < 10)
-                })
-
-        for c in prices.columns:
-            prev = prev_prices[c]
-            if prev == 0 or np.isnan(prev):
-                ret = 0.0
-            else:
-                ret = (row[c] - prev) / prev
-            holding_value[c] *= (1.0 + (ret if not np.isnan(ret) else 0.0))
-
-        total_val = sum(holding_value.values())
-        portfolio_values.append((dt, total_val))
-        per_asset_values.append((dt, {c: holding_value[c] for c in prices.columns}))
-        prev_prices = row
-
-    pf = pd.Series({dt: v for dt, v in portfolio_values}).sort_index()
-    asset_df = pd.DataFrame({dt: vals for dt, vals in per_asset_values}).T
-    asset_df.index = pf.index
-    daily_ret = pf.pct_change().fillna(0.0)
-    events_df = pd.DataFrame(events_rows)
+    RMAX20 = _rolling_max(P_eq, 20)
+    R10 = np.full(P_eq.shape, np.nan)
+    R10[10:] = P_eq[10:] / P_eq[:-10] - 1.0
+    # 每日原始档位（站上均线条数），以及“最近 confirm_days 日档位一致”的确认标记
+    TIER = (P_eq > S50).astype(np.int8) + (P_eq > S100) + (P_eq > S200)
+    k_conf = int(confirm_days)
+    stable = np.zeros(TIER.shape, dtype=bool)
+    if 0 < k_conf <= len(TIER):
+        win = np.lib.stride_tricks.sliding_window_view(TIER, k_conf, axis=0)
+        stable[k_conf - 1:] = win.max(axis=-1) == win.min(axis=-1)
+
+    kernel = _make_tvalue_kernel(len(equity_like), cash_idx >= 0, bond_idx >= 0, int(cooldown_days))
+    H, n_ev, ev_day, ev_weight, ev_factor, ev_reason, ev_prev_tier, ev_new_tier, ev_dd, ev_cooldown = kernel(
+        _daily_returns(P), P_eq, S50, S100, S200, RMAX20, R10, TIER, stable, day_no, w, eq_idx, cash_idx, bond_idx
+    )
+
+    pf, daily_ret, asset_df = _holdings_to_frames(prices, H)
+
+    # 事件缓冲区展开为“每个调仓日 × 每个资产”一行；非权益资产的因子/档位取默认值
+    n_assets = len(codes)
+    days = ev_day[:n_ev]
+    factor = np.ones((n_ev, n_assets))
+    factor[:, eq_idx] = ev_factor[:n_ev]
+    reason = np.full((n_ev, n_assets), "", dtype=object)
+    reason[:, eq_idx] = _TVALUE_REASONS[ev_reason[:n_ev]]
+    for e, j in zip(*np.nonzero(ev_reason[:n_ev] == _REASON_EMERGENCY)):
+        reason[e, eq_idx[j]] = f"emergency_cut_dd{ev_dd[e, j]:.1%}"
+    prev_tier = np.full((n_ev, n_assets), 2, dtype=np.int64)
+    prev_tier[:, eq_idx] = ev_prev_tier[:n_ev]
+    new_tier = np.full((n_ev, n_assets), 2, dtype=np.int64)
+    new_tier[:, eq_idx] = ev_new_tier[:n_ev]
+    cooldown = np.zeros((n_ev, n_assets), dtype=bool)
+    cooldown[:, eq_idx] = ev_cooldown[:n_ev]
+
+    def _eq_values(arr):
+        out = np.full((n_ev, n_assets), np.nan)
+        out[:, eq_idx] = arr[days]
+        return out.ravel()
+
+    events_df = pd.DataFrame({
+        "date": np.repeat(prices.index.values[days], n_assets),
+        "event": "tvalue_rebalance",
+        "asset": np.tile(np.asarray(codes, dtype=object), n_ev),
+        "new_weight": ev_weight[:n_ev].ravel(),
+        "factor": factor.ravel(),
+        "reason": reason.ravel(),
+        "prev_tier": prev_tier.ravel(),
+        "new_tier": new_tier.ravel(),
+        "price": P[days].ravel(),
+        "sma50": _eq_values(S50),
+        "sma100": _eq_values(S100),
+        "sma200": _eq_values(S200),
+        "ret10": _eq_values(R10),
+        "cooldown": cooldown.ravel(),
+    })
     return pf, daily_ret, asset_df, events_df
 
 
@@ -294,8 +387,6 @@ def _simulate_momentum_portfolio(prices: pd.DataFrame, weights: Dict[str, float]
     3. 若收益率 > 0，保持原权重
     4. 若收益率 <= 0，清仓该资产，资金按 6:5 分配给 长债(511010) 和 货币(511880)
     """
-    start_val = 1.0
-    
     # 识别资产类型
     cash_code = None
     bond_code = None
@@ -307,36 +398,44 @@ def _simulate_momentum_portfolio(prices: pd.DataFrame, weights: Dict[str, float]
     
     # 风险资产池（排除长债和现金）
     risk_assets = [c for c in prices.columns if c not in {cash_code, bond_code}]
+    col_idx = {c: k for k, c in enumerate(prices.columns)}
     
-    # 初始化持仓
-    holding_value = {c: start_val * weights.get(c, 0.0) for c in prices.columns}
-    
-    portfolio_values = []
-    per_asset_values = []
-    events_rows = []
+    # 初始化持仓：按列顺序的市值向量，逐日写入 H
+    w = np.array([weights.get(c, 0.0) for c in prices.columns], dtype=np.float64)
+    holding = w.copy()
+    H = np.empty((len(prices), len(prices.columns)), dtype=np.float64)
+    P = prices.to_numpy(dtype=np.float64)
+    R = _daily_returns(P)
     
     # 再平衡日期（每月月初/第一个交易日）
     norm_freq = _normalize_freq(freq)
-    rebal_dates = set(prices.resample(norm_freq).first().index) if norm_freq else set()
+    rebal_dates = prices.resample(norm_freq).first().index if norm_freq else pd.DatetimeIndex([])
+    is_rebal = prices.index.isin(rebal_dates)
+
+    # 清仓事件按列预分配（上限：调仓日数 × 风险资产数），n_ev 为写入游标
+    ev_cap = int(is_rebal.sum()) * len(risk_assets)
+    ev_day = np.empty(ev_cap, dtype=np.int64)
+    ev_asset = np.empty(ev_cap, dtype=np.int64)
+    ev_mom = np.empty(ev_cap, dtype=np.float64)
+    n_ev = 0
     
     # 转换窗口天数：momentum_window (月) -> 交易日 (约 * 20)
     # 假设输入 momentum_window 是月份数，这里转换为交易日
     lookback_days = int(momentum_window * 20)
     
-    prev_prices = prices.iloc[0]
-    
     # 记录每个资产当前的“目标状态”：True=持有风险，False=避险
     # 初始默认都持有
     asset_status = {c: True for c in risk_assets}
     
-    for dt, row in prices.iterrows():
+    for i in range(len(P)):
+        row = P[i]
         # 1. 检查是否是调仓日
-        if dt in rebal_dates:
+        if is_rebal[i]:
             # 计算总资产
-            total_val = sum(holding_value.values())
+            total_val = holding.sum()
             
             # 计算新的目标权重
-            target_weights = {}
+            target_weights = np.zeros(len(prices.columns), dtype=np.float64)
             
             # 基础权重分配（避险资产先拿自己的基础份额）
             w_bond_base = weights.get(bond_code, 0.0) if bond_code else 0.0
@@ -346,8 +445,6 @@ def _simulate_momentum_portfolio(prices: pd.DataFrame, weights: Dict[str, float]
             w_bond_extra = 0.0
             w_cash_extra = 0.0
             
-            current_idx = prices.index.get_loc(dt)
-            
             for c in risk_assets:
                 w_base = weights.get(c, 0.0)
                 
@@ -356,9 +453,9 @@ def _simulate_momentum_portfolio(prices: pd.DataFrame, weights: Dict[str, float]
                 momentum_val = 0.0
                 has_history = False
                 
-                if current_idx >= lookback_days:
-                    past_price = prices[c].iloc[current_idx - lookback_days]
-                    curr_price = row[c]
+                if i >= lookback_days:
+                    past_price = P[i - lookback_days, col_idx[c]]
+                    curr_price = row[col_idx[c]]
                     if past_price > 0:
                         momentum_val = (curr_price / past_price) - 1.0
                         has_history = True
@@ -373,68 +470,62 @@ def _simulate_momentum_portfolio(prices: pd.DataFrame, weights: Dict[str, float]
                 
                 if is_positive:
                     # 动量为正，维持原权重
-                    target_weights[c] = w_base
+                    target_weights[col_idx[c]] = w_base
                 else:
                     # 动量为负，清仓，权重分给债/现
-                    target_weights[c] = 0.0
+                    target_weights[col_idx[c]] = 0.0
                     # 比例 6:5 -> 债 6/11, 现 5/11
                     w_bond_extra += w_base * (6.0 / 11.0)
                     w_cash_extra += w_base * (5.0 / 11.0)
                     
-                    events_rows.append({
-                        "date": dt,
-                        "event": "momentum_cut",
-                        "asset": c,
-                        "momentum_ret": float(momentum_val),
-                        "lookback": lookback_days
-                    })
+                    ev_day[n_ev] = i
+                    ev_asset[n_ev] = col_idx[c]
+                    ev_mom[n_ev] = momentum_val
+                    n_ev += 1
             
             # 分配避险资产权重
             if bond_code:
-                target_weights[bond_code] = w_bond_base + w_bond_extra
+                target_weights[col_idx[bond_code]] = w_bond_base + w_bond_extra
             elif cash_code:
                 # 如果没有长债ETF，全给现金
-                target_weights[cash_code] = w_cash_base + w_cash_extra + w_bond_extra # 全给现金
+                target_weights[col_idx[cash_code]] = w_cash_base + w_cash_extra + w_bond_extra # 全给现金
             
             if cash_code:
-                target_weights[cash_code] = target_weights.get(cash_code, 0.0) + w_cash_base + w_cash_extra
+                target_weights[col_idx[cash_code]] += w_cash_base + w_cash_extra
             elif bond_code:
                  # 如果没有现金ETF，全给长债
-                target_weights[bond_code] = target_weights.get(bond_code, 0.0) + w_cash_extra
+                target_weights[col_idx[bond_code]] += w_cash_extra
 
-            # 执行调仓：更新 holding_value
+            # 执行调仓：更新 holding
             # 归一化检查（理论上应该和为1）
-            sum_w = sum(target_weights.values())
+            sum_w = target_weights.sum()
             if sum_w > 0:
-                for k in target_weights:
-                    target_weights[k] /= sum_w
+                target_weights /= sum_w
             
-            for c in prices.columns:
-                holding_value[c] = total_val * target_weights.get(c, 0.0)
+            holding = total_val * target_weights
 
         # 2. 计算日内净值变化
-        for c in prices.columns:
-            prev = prev_prices[c]
-            if prev == 0 or np.isnan(prev):
-                ret = 0.0
-            else:
-                ret = (row[c] - prev) / prev
-            holding_value[c] *= (1.0 + (ret if not np.isnan(ret) else 0.0))
-            
-        total_val = sum(holding_value.values())
-        portfolio_values.append((dt, total_val))
-        per_asset_values.append((dt, {c: holding_value[c] for c in prices.columns}))
-        prev_prices = row
-
-    pf = pd.Series({dt: v for dt, v in portfolio_values}).sort_index()
-    asset_df = pd.DataFrame({dt: vals for dt, vals in per_asset_values}).T
-    asset_df.index = pf.index
-    daily_ret = pf.pct_change().fillna(0.0)
-    events_df = pd.DataFrame(events_rows)
+        holding *= 1.0 + R[i]
+        H[i] = holding
+
+    pf, daily_ret, asset_df = _holdings_to_frames(prices, H)
+    if n_ev:
+        events_df = pd.DataFrame({
+            "date": prices.index.values[ev_day[:n_ev]],
+            "event": "momentum_cut",
+            "asset": prices.columns.values[ev_asset[:n_ev]],
+            "momentum_ret": ev_mom[:n_ev],
+            "lookback": lookback_days,
+        })
+    else:
+        events_df = pd.DataFrame()
     return pf, daily_ret, asset_df, events_df
 
 
-def backtest(prices_map: Dict[str, pd.DataFrame], weights: Dict[str, float], start_date: str = None, end_date: str = None, freq: str = "M", strategy: str = "fixed", sma_short: int = 50, sma_mid: int = 100, sma_long: int = 200, confirm_days: int = 5, cooldown_days: int = 10, momentum_window: int = 10):
+def prepare_prices(prices_map: Union[pd.DataFrame, Dict[str, pd.DataFrame]], start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """对齐各资产收盘价为宽表并按起止日期截取。
+    prices_map 可为收盘价宽表（日期索引、每列一个资产代码），或旧式的 {代码: 单资产DataFrame} 映射。
+    """
     logger = get_logger("backtest")
     prices = _prepare_price_frame(prices_map)
     if start_date:
@@ -443,20 +534,33 @@ def backtest(prices_map: Dict[str, pd.DataFrame], weights: Dict[str, float], sta
         prices = prices.loc[:pd.to_datetime(end_date)]
     prices = prices.dropna(how="all")
     logger.info(f"Price frame prepared: {prices.index.min()} -> {prices.index.max()} | {list(prices.columns)}")
+    return prices
+
 
+def precompute_smas(prices: pd.DataFrame, windows) -> Dict[int, np.ndarray]:
+    """按窗口预先计算价格宽表各列的简单移动均线，供参数网格搜索复用。"""
+    return {w: prices.rolling(w).mean().to_numpy(dtype=np.float64) for w in sorted({int(x) for x in windows})}
+
+
+def run_backtest(prices: pd.DataFrame, weights: Dict[str, float], freq: str = "M", strategy: str = "fixed", sma_short: int = 50, sma_mid: int = 100, sma_long: int = 200, confirm_days: int = 5, cooldown_days: int = 10, momentum_window: int = 10, sma_cache: Optional[Dict[int, np.ndarray]] = None):
+    """在已准备好的价格宽表上运行策略；sma_cache 为 precompute_smas 的结果（可选）。"""
     if str(strategy).lower() == "tvalue":
-        pf, daily_ret, asset_val, events = _simulate_tvalue_portfolio(prices, weights, sma_short=sma_short, sma_mid=sma_mid, sma_long=sma_long, confirm_days=confirm_days, cooldown_days=cooldown_days)
+        return _simulate_tvalue_portfolio(prices, weights, sma_short=sma_short, sma_mid=sma_mid, sma_long=sma_long, confirm_days=confirm_days, cooldown_days=cooldown_days, sma_cache=sma_cache)
     elif str(strategy).lower() == "momentum":
-        pf, daily_ret, asset_val, events = _simulate_momentum_portfolio(prices, weights, momentum_window=momentum_window, freq=freq)
-    else:
-        pf, daily_ret, asset_val, events = _simulate_rebalanced_portfolio(prices, weights, freq=freq)
+        return _simulate_momentum_portfolio(prices, weights, momentum_window=momentum_window, freq=freq)
+    return _simulate_rebalanced_portfolio(prices, weights, freq=freq)
+
+
+def backtest(prices_map: Union[pd.DataFrame, Dict[str, pd.DataFrame]], weights: Dict[str, float], start_date: str = None, end_date: str = None, freq: str = "M", strategy: str = "fixed", sma_short: int = 50, sma_mid: int = 100, sma_long: int = 200, confirm_days: int = 5, cooldown_days: int = 10, momentum_window: int = 10):
+    prices = prepare_prices(prices_map, start_date=start_date, end_date=end_date)
+    pf, daily_ret, asset_val, events = run_backtest(prices, weights, freq=freq, strategy=strategy, sma_short=sma_short, sma_mid=sma_mid, sma_long=sma_long, confirm_days=confirm_days, cooldown_days=cooldown_days, momentum_window=momentum_window)
     return pf, daily_ret, asset_val, prices, events
 
 
-def max_drawdown(series: pd.Series) -> Tuple[float, pd.Timestamp, pd.Timestamp]:
-    cummax = series.cummax()
-    drawdown = series / cummax - 1.0
-    mdd = drawdown.min()
-    end = drawdown.idxmin()
-    start = series.loc[:end].idxmax()
-    return float(mdd), start, end
\ No newline at end of file
+def max_drawdown(series: pd.Series) -> Tuple[float, pd.Timestamp, pd.Timestamp, float, float]:
+    """返回 (最大回撤, 峰值日期, 谷值日期, 峰值, 谷值)。"""
+    v = series.to_numpy(dtype=np.float64)
+    drawdown = v / np.maximum.accumulate(v) - 1.0
+    e = int(drawdown.argmin())
+    st = int(v[:e + 1].argmax())
+    return float(drawdown[e]), pd.Timestamp(series.index[st]), pd.Timestamp(series.index[e]), float(v[st]), float(v[e])
\ No newline at end of file
@@ -22,6 +22,10 @@ END_DATE = _today.strftime("%Y-%m-%d")
 # 访问频控：随机间隔（秒）以降低被限风险
 REQUEST_INTERVAL_MIN_SECONDS = 1.0
 REQUEST_INTERVAL_MAX_SECONDS = 3.0
+# 并发抓取的最大线程数（多个ETF同时请求；过大易触发 Tushare 频控）
+FETCH_MAX_WORKERS = 4
+# 单次请求的日期跨度（天）：约7年≈1700个交易日，低于 Tushare 基金日线/复权因子单次2000行上限
+FETCH_SLICE_DAYS = 2555
 
 # 价格复权模式：'none' 不复权，'qfq' 前复权，'hfq' 后复权
 # 注：ETF在 Tushare 的 pro_bar(asset='E') 对部分品种支持前/后复权；
@@ -39,6 +43,8 @@ LOG_DIR = "logs"
 REBALANCE_FREQ = "NONE"
 RISK_FREE_ANNUAL = 0.0  # 夏普比率风险自由利率（年化），默认0
 STRATEGY_MODE = "fixed"
+# 网格搜索并行进程数；None 表示使用全部 CPU 核心，1 表示在主进程串行执行
+GRIDSEARCH_MAX_WORKERS = None
 
 # 验证参数
 MAX_ABS_DAILY_RETURN = 0.20  # 单日涨跌幅超过此阈值标记为异常
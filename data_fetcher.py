@@ -1,7 +1,8 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import os
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from datetime import timedelta
@@ -9,11 +10,11 @@ from datetime import timedelta
 from utils import (
     get_logger,
     ensure_directories,
-    sleep_random_with_log,
+    make_request_pacer,
     to_ts_code,
     align_to_trading_days,
 )
-from config import DATA_DIR, REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, ETF_ADJUST_MODE
+from config import DATA_DIR, REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, ETF_ADJUST_MODE, FETCH_MAX_WORKERS, FETCH_SLICE_DAYS
 
 
 def init_tushare(token: str):
@@ -23,21 +24,23 @@ def init_tushare(token: str):
     return ts, pro
 
 
-def _fetch_slice(ts, pro, ts_code: str, start_date: str, end_date: str, logger: logging.Logger, latest_adj_factor: float | None = None) -> pd.DataFrame:
+def _fetch_slice(ts, pro, ts_code: str, start_date: str, end_date: str, logger: logging.Logger) -> pd.DataFrame:
     """拉取一个小区间的数据。
-    使用 fund_adj 的复权因子，与当日收盘价（fund_daily 优先、daily 作为回退）合并，
-    在配置为前复权(qfq)时计算：前复权收盘价 = 当日收盘价 ÷ 当日复权因子。
+    使用 fund_adj 的复权因子，与当日收盘价（fund_daily 优先、daily 作为回退）合并；
+    前复权(qfq)时返回原始收盘价及 adj_factor 列，由 fetch_daily_close 统一锚定最新因子换算。
     """
     start = pd.to_datetime(start_date).strftime("%Y%m%d")
     end = pd.to_datetime(end_date).strftime("%Y%m%d")
     logger.info(f"Fetching slice {ts_code} from {start} to {end}...")
     df = None
     try:
-        # 1) 复权因子：基金/ETF复权因子（每日）
-        logger.info("Using fund_adj for adj_factor")
-        adj = pro.fund_adj(ts_code=ts_code, start_date=start, end_date=end)
-        if adj is None or adj.empty:
-            logger.warning("fund_adj returned empty factors; will use raw close only")
+        # 1) 复权因子：基金/ETF复权因子（每日）；仅前复权需要，其它模式省去该次请求
+        adj = None
+        if str(ETF_ADJUST_MODE).lower() == 'qfq':
+            logger.info("Using fund_adj for adj_factor")
+            adj = pro.fund_adj(ts_code=ts_code, start_date=start, end_date=end)
+            if adj is None or adj.empty:
+                logger.warning("fund_adj returned empty factors; will use raw close only")
 
         # 2) 当日收盘价：基金/ETF日线；为空时回退到 daily
         logger.info("Fetching fund_daily close (preferred)")
@@ -50,17 +53,12 @@ def _fetch_slice(ts, pro, ts_code: str, start_date: str, end_date: str, logger:
             px = px.sort_values("trade_date")[['ts_code','trade_date','close']]
             if adj is not None and not adj.empty and 'adj_factor' in adj.columns:
                 adj = adj[['ts_code','trade_date','adj_factor']].sort_values('trade_date')
-                # 合并并根据配置计算前复权
+                # 合并复权因子
                 df = pd.merge(px, adj, on=['ts_code','trade_date'], how='left')
                 # 若有缺失的复权因子，前向填充以提高连续性
-                df['adj_factor'] = df['adj_factor'].astype(float)
-                df['adj_factor'] = df['adj_factor'].fillna(method='ffill').fillna(method='bfill')
-                if str(ETF_ADJUST_MODE).lower() == 'qfq':
-                    # 锚定区间最新复权因子，前复权价 = close * adj_factor / latest_adj_factor
-                    la = float(latest_adj_factor) if latest_adj_factor and latest_adj_factor > 0 else float(df['adj_factor'].iloc[-1])
-                    df['close'] = df['close'].astype(float) * df['adj_factor'] / la
+                df['adj_factor'] = df['adj_factor'].astype(float).ffill().bfill()
                 # 仅保留必要字段
-                df = df[["ts_code", "trade_date", "close"]]
+                df = df[["ts_code", "trade_date", "close", "adj_factor"]]
             else:
                 # 无复权因子，仅返回原始收盘价
                 df = px[["ts_code", "trade_date", "close"]]
@@ -89,14 +87,8 @@ def _date_slices(start_date: str, end_date: str, step_days: int = 365) -> List[t
 def fetch_daily_close(ts, pro, ts_code: str, start_date: str, end_date: str, logger: logging.Logger) -> pd.DataFrame:
     """分页抓取并合并，确保得到完整区间数据。"""
     frames: List[pd.DataFrame] = []
-    # 预先获取整个区间的最新复权因子，用于锚定
-    try:
-        adj_all = pro.fund_adj(ts_code=ts_code, start_date=pd.to_datetime(start_date).strftime('%Y%m%d'), end_date=pd.to_datetime(end_date).strftime('%Y%m%d'))
-        latest_adj_factor = float(adj_all.sort_values('trade_date')['adj_factor'].iloc[-1]) if adj_all is not None and not adj_all.empty else None
-    except Exception:
-        latest_adj_factor = None
-    for s, e in _date_slices(start_date, end_date, step_days=365):
-        df = _fetch_slice(ts, pro, ts_code, s, e, logger, latest_adj_factor=latest_adj_factor)
+    for s, e in _date_slices(start_date, end_date, step_days=FETCH_SLICE_DAYS):
+        df = _fetch_slice(ts, pro, ts_code, s, e, logger)
         if df is not None and not df.empty:
             frames.append(df)
     if not frames:
@@ -104,10 +96,51 @@ def fetch_daily_close(ts, pro, ts_code: str, start_date: str, end_date: str, log
         return pd.DataFrame(columns=["ts_code", "trade_date", "close"])  # 空占位
     df_all = pd.concat(frames, axis=0)
     df_all = df_all.drop_duplicates(subset=["trade_date"]).sort_values("trade_date")
+    if "adj_factor" in df_all.columns:
+        # 前复权：锚定整个区间最新复权因子，前复权价 = close * adj_factor / latest_adj_factor；
+        # 缺少因子的片段保留原始收盘价
+        factors = df_all["adj_factor"].astype(float)
+        valid = factors.dropna()
+        if not valid.empty and valid.iloc[-1] > 0:
+            adjusted = df_all["close"].astype(float) * factors / float(valid.iloc[-1])
+            df_all["close"] = adjusted.where(factors.notna(), df_all["close"].astype(float))
+        df_all = df_all.drop(columns=["adj_factor"])
     df_all = align_to_trading_days(df_all)
     return df_all
 
 
+# 收盘价统一保留三位小数、日期统一为 YYYY-MM-DD，均在写出时由 CSV 格式化完成
+PRICE_FLOAT_FORMAT = "%.3f"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def read_close_csv(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """读取本地收盘价 CSV（列：交易日期, ETF代码, 收盘价），交易日期解析为 datetime64、收盘价为 float64。
+    columns 指定时只解析这些列。安装 pyarrow 时由其 CSV 读取器一次扫描完成类型转换；否则回退到 pandas 解析。
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+    except ImportError:
+        parse_dates = ["交易日期"] if columns is None or "交易日期" in columns else False
+        return pd.read_csv(path, usecols=columns, parse_dates=parse_dates)
+    convert = pacsv.ConvertOptions(
+        column_types={"交易日期": pa.timestamp("ns"), "ETF代码": pa.string(), "收盘价": pa.float64()},
+        timestamp_parsers=[pacsv.ISO8601, "%Y%m%d"],
+        include_columns=columns,
+    )
+    return pacsv.read_csv(path, convert_options=convert).to_pandas()
+
+
+def _csv_line_ending(path: str) -> Tuple[str, bool]:
+    """按已有文件末尾判断换行符（仓库自带数据为 CRLF），并返回文件是否以换行结尾。"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        tail = f.read()
+    return ("\r\n" if b"\r\n" in tail else "\n"), (not tail or tail.endswith(b"\n"))
+
+
 def save_to_csv(df: pd.DataFrame, ts_code: str, logger: logging.Logger) -> str:
     ensure_directories()
     out_path = os.path.join(DATA_DIR, f"{ts_code.replace('.', '_')}.csv")
@@ -119,26 +152,39 @@ def save_to_csv(df: pd.DataFrame, ts_code: str, logger: logging.Logger) -> str:
     if "收盘价" not in df_out.columns and "close" in df_out.columns:
         df_out["收盘价"] = df_out["close"]
     if "交易日期" in df_out.columns:
-        df_out["交易日期"] = pd.to_datetime(df_out["交易日期"]).dt.strftime("%Y-%m-%d")
+        # 日期全程保持 datetime64，仅在写出时按 DATE_FORMAT 格式化
+        df_out["交易日期"] = pd.to_datetime(df_out["交易日期"])
     df_out = df_out[["交易日期", "ETF代码", "收盘价"]]
 
-    # 收盘价统一保留三位小数（数值类型；不转成字符串，避免后续读入时报错）
-    df_out["收盘价"] = pd.to_numeric(df_out["收盘价"], errors="coerce").round(3)
-
-    # 若已有文件，进行合并去重，避免覆盖历史数据
+    # 若已有文件：新增日期全部晚于历史末日时直接追加，否则合并去重，避免覆盖历史数据
+    line_end = os.linesep
     if os.path.exists(out_path):
+        # 沿用已有文件的换行符，避免增量写入后同一文件混用 CRLF/LF
+        line_end, ends_with_newline = _csv_line_ending(out_path)
         try:
-            old = pd.read_csv(out_path)
+            old_dates = pd.read_csv(out_path, usecols=["交易日期"], parse_dates=["交易日期"], engine="c")["交易日期"]
+            fresh = df_out[~df_out["交易日期"].isin(old_dates)]
+            if old_dates.empty or fresh.empty or fresh["交易日期"].min() > old_dates.max():
+                fresh = fresh.drop_duplicates(subset=["交易日期"]).sort_values("交易日期")
+                if not fresh.empty:
+                    # 追加写入不带 BOM，文件头的 BOM 已由首次写入生成
+                    with open(out_path, "a", encoding="utf-8", newline="") as f:
+                        if not ends_with_newline:
+                            f.write(line_end)
+                        fresh.to_csv(f, header=False, index=False, float_format=PRICE_FLOAT_FORMAT, date_format=DATE_FORMAT, lineterminator=line_end)
+                logger.info(f"Appended {len(fresh)} rows to {ts_code} CSV -> {out_path}")
+                return out_path
+        except Exception as e:
+            logger.warning(f"Failed to append to existing CSV for {ts_code}: {e}. Falling back to full merge.")
+        try:
+            old = read_close_csv(out_path)
             merged = pd.concat([old, df_out], axis=0)
-            merged["交易日期"] = pd.to_datetime(merged["交易日期"]).dt.strftime("%Y-%m-%d")
             merged = merged.drop_duplicates(subset=["交易日期"]).sort_values("交易日期")
-            # 合并后同样统一三位小数
-            merged["收盘价"] = pd.to_numeric(merged["收盘价"], errors="coerce").round(3)
             df_out = merged
         except Exception as e:
             logger.warning(f"Failed to merge existing CSV for {ts_code}: {e}. Overwriting with new data.")
 
-    df_out.to_csv(out_path, index=False, encoding="utf-8-sig")
+    df_out.to_csv(out_path, index=False, encoding="utf-8-sig", float_format=PRICE_FLOAT_FORMAT, date_format=DATE_FORMAT, lineterminator=line_end)
     logger.info(f"Saved {ts_code} CSV -> {out_path}")
     return out_path
 
@@ -147,12 +193,18 @@ def fetch_and_save_many(token: str, codes: List[str], start_date: str, end_date:
     logger = get_logger("fetch")
     ensure_directories()
     ts, pro = init_tushare(token)
-    outputs: Dict[str, str] = {}
-    for raw in codes:
-        ts_code = to_ts_code(raw)
+    # 所有线程共用一个节流器：各代码的请求发起时刻至少相隔随机间隔，网络耗时则可重叠
+    pace = make_request_pacer(REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, logger)
+
+    def _fetch_one(ts_code: str) -> str:
+        pace()
         df = fetch_daily_close(ts, pro, ts_code, start_date, end_date, logger)
-        path = save_to_csv(df, ts_code, logger)
-        outputs[ts_code] = path
-        # 随机间隔以降低限流风险
-        sleep_random_with_log(REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, logger)
-    return outputs
\ No newline at end of file
+        return save_to_csv(df, ts_code, logger)
+
+    # 先解析后缀并去重：同一 ETF 的不同写法（如 510300 与 510300.SH）不能并发写同一个 CSV
+    ts_codes = list(dict.fromkeys(to_ts_code(c) for c in codes))
+    # 网络请求为 I/O 密集型，多线程重叠各代码的等待时间；并发数受 FETCH_MAX_WORKERS 限制
+    with ThreadPoolExecutor(max_workers=max(1, int(FETCH_MAX_WORKERS))) as pool:
+        futures = [pool.submit(_fetch_one, ts_code) for ts_code in ts_codes]
+        # 按代码顺序取结果，任一代码失败时异常照常抛出
+        return {ts_code: fut.result() for ts_code, fut in zip(ts_codes, futures)}
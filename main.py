@@ -1,7 +1,12 @@
 import argparse
-from typing import Dict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List
+import itertools
+import logging
 import os
 
+import numpy as np
 import pandas as pd
 
 from config import (
@@ -12,50 +17,88 @@ from config import (
     REBALANCE_FREQ,
     STRATEGY_MODE,
     DATA_DIR,
+    FETCH_MAX_WORKERS,
+    GRIDSEARCH_MAX_WORKERS,
     REQUEST_INTERVAL_MIN_SECONDS,
     REQUEST_INTERVAL_MAX_SECONDS,
 )
-from utils import get_logger, ensure_directories, to_ts_code, sleep_random_with_log
-from data_fetcher import init_tushare, fetch_and_save_many, fetch_daily_close, save_to_csv
-from validator import check_completeness, detect_anomalies, cross_validate_with_akshare
-from backtest import backtest
-from report import generate_markdown_report, save_holdings_csv, save_events_csv, compute_metrics
-from visualization import make_portfolio_figure, save_figure_html
+from utils import get_logger, ensure_directories, to_ts_code, make_request_pacer, align_to_trading_days
+# 各阶段依赖（tushare/plotly/numba 等）在对应 stage_* 内按需导入，避免无关动作承担导入开销
+
+
+@lru_cache(maxsize=64)
+def _load_csv_close_cached(path: str, mtime: float) -> pd.DataFrame:
+    """按 (路径, 修改时间) 缓存解析结果；CSV 更新后 mtime 变化自动失效。"""
+    from data_fetcher import read_close_csv
+    pq_path = path[: -len(".csv")] + ".parquet"
+    # 优先读取未过期的 parquet 旁路缓存（比 CSV + 日期解析快得多）
+    if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= mtime:
+        try:
+            return pd.read_parquet(pq_path)
+        except Exception:
+            pass
+    df = read_close_csv(path)
+    df.rename(columns={"交易日期": "trade_date", "ETF代码": "ts_code", "收盘价": "close"}, inplace=True)
+    df = df.set_index("trade_date").sort_index()
+    # 未安装 pyarrow/fastparquet 时跳过写缓存，不影响结果
+    try:
+        df.to_parquet(pq_path)
+    except Exception:
+        pass
+    return df
 
 
 def load_csv_close(ts_code: str) -> pd.DataFrame:
-    import os
-    from config import DATA_DIR
     path = os.path.join(DATA_DIR, f"{ts_code.replace('.', '_')}.csv")
-    df = pd.read_csv(path)
-    df.rename(columns={"交易日期": "trade_date", "ETF代码": "ts_code", "收盘价": "close"}, inplace=True)
-    df["trade_date"] = pd.to_datetime(df["trade_date"])
-    df.sort_values("trade_date", inplace=True)
-    return df.set_index("trade_date")
+    # 返回副本，避免调用方修改污染缓存
+    return _load_csv_close_cached(path, os.path.getmtime(path)).copy()
+
+
+def load_wide_closes(codes: List[str]) -> pd.DataFrame:
+    """读取多个资产的收盘价并一次外连接为宽表（日期索引 × 代码列），缺失日期为 NaN。"""
+    series = []
+    for code in codes:
+        s = load_csv_close(code)["close"].dropna()
+        series.append(s[~s.index.duplicated()].rename(code))
+    return pd.concat(series, axis=1, join="outer").sort_index()
+
+
+def _resolve_codes(args) -> List[str]:
+    """返回带后缀的代码列表：main() 解析参数后统一写入 args.resolved_codes，直接调用 stage_* 时按需补算一次。"""
+    if getattr(args, "resolved_codes", None) is None:
+        args.resolved_codes = [to_ts_code(c) for c in args.codes]
+    return args.resolved_codes
 
 
 def stage_fetch(args):
     logger = get_logger("stage_fetch")
-    codes = [to_ts_code(c) for c in args.codes]
+    from data_fetcher import fetch_and_save_many
+    codes = _resolve_codes(args)
     fetch_and_save_many(TUSHARE_TOKEN, codes, args.start, args.end)
     logger.info("Fetch stage completed.")
 
 
 def stage_update(args):
     logger = get_logger("stage_update")
+    from data_fetcher import init_tushare, fetch_daily_close, save_to_csv, read_close_csv
     ensure_directories()
     ts, pro = init_tushare(TUSHARE_TOKEN)
-    codes = [to_ts_code(c) for c in args.codes]
+    # 去重：同一 ETF 的不同写法（如 510300 与 510300.SH）不能并发写同一个 CSV
+    codes = list(dict.fromkeys(_resolve_codes(args)))
     # 若未指定结束日期，使用今天
     end_date = args.end or pd.Timestamp.today().strftime("%Y-%m-%d")
-    for code in codes:
+    # 所有线程共用一个节流器：请求发起间隔与原先串行随机等待一致，网络耗时则可重叠
+    pace = make_request_pacer(REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, logger)
+
+    def _update_one(code: str) -> None:
         start_date = args.start
         path = os.path.join(DATA_DIR, f"{code.replace('.', '_')}.csv")
         if os.path.exists(path):
             try:
-                df_old = pd.read_csv(path)
+                # 只需最后交易日，仅解析日期列
+                df_old = read_close_csv(path, columns=["交易日期"])
                 if not df_old.empty and "交易日期" in df_old.columns:
-                    last_dt = pd.to_datetime(df_old["交易日期"]).max().date()
+                    last_dt = df_old["交易日期"].max().date()
                     # 从下一交易日开始增量
                     start_date = (pd.Timestamp(last_dt) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
                     logger.info(f"{code} 已有至 {last_dt}, 增量起始 {start_date} -> {end_date}")
@@ -64,37 +107,44 @@ def stage_update(args):
         # 若起始超过结束，则无需更新
         if pd.to_datetime(start_date) > pd.to_datetime(end_date):
             logger.info(f"{code} 无需更新：已有数据已覆盖到 {end_date}")
-            continue
+            return
+        pace()
         df_new = fetch_daily_close(ts, pro, code, start_date, end_date, logger)
         if df_new is None or df_new.empty:
             logger.info(f"{code} 无增量数据")
         else:
             save_to_csv(df_new, code, logger)
-        sleep_random_with_log(REQUEST_INTERVAL_MIN_SECONDS, REQUEST_INTERVAL_MAX_SECONDS, logger)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(FETCH_MAX_WORKERS))) as pool:
+        # 按代码顺序取结果，任一代码失败时异常照常抛出
+        for fut in [pool.submit(_update_one, code) for code in codes]:
+            fut.result()
     logger.info("Update stage completed.")
 
 
 def stage_validate(args):
     logger = get_logger("stage_validate")
-    import tushare as ts
+    from data_fetcher import init_tushare
+    from validator import check_completeness, detect_anomalies, cross_validate_with_akshare
     ts, pro = init_tushare(TUSHARE_TOKEN)
-    codes = [to_ts_code(c) for c in args.codes]
+    codes = _resolve_codes(args)
     for code in codes:
-        df = load_csv_close(code)
-        ok, missing_df = check_completeness(df.reset_index(), pro, args.start, args.end, logger)
-        anomalies = detect_anomalies(df.reset_index(), logger)
-        cross_ok, merged = cross_validate_with_akshare(code, df.reset_index(), args.start, args.end, logger)
+        # 对齐（排序、去重）一次，供三项检查共用
+        df = align_to_trading_days(load_csv_close(code).reset_index())
+        ok, missing_df = check_completeness(df, pro, args.start, args.end, logger, pre_aligned=True, refresh_calendar=args.refresh_calendar)
+        anomalies = detect_anomalies(df, logger, pre_aligned=True)
+        cross_ok, merged = cross_validate_with_akshare(code, df, args.start, args.end, logger, pre_aligned=True)
         logger.info(f"Validation {code}: completeness={ok}, anomalies={len(anomalies)}, cross_ok={cross_ok}")
     logger.info("Validation stage completed.")
 
 
 def stage_backtest(args):
     logger = get_logger("stage_backtest")
-    # 准备价格映射
-    price_map: Dict[str, pd.DataFrame] = {}
-    for code in [to_ts_code(c) for c in args.codes]:
-        df = load_csv_close(code)
-        price_map[code] = df
+    from backtest import backtest
+    from report import generate_markdown_report, save_holdings_csv, save_events_csv, compute_yearly_metrics, save_yearly_metrics
+    from visualization import make_portfolio_figure, save_figure_html
+    # 各资产收盘价一次拼为宽表
+    closes = load_wide_closes(_resolve_codes(args))
 
     # 权重
     weights = {to_ts_code(k): v for k, v in ETF_WEIGHTS.items()} if args.use_default_weights else {}
@@ -113,7 +163,7 @@ def stage_backtest(args):
     momentum_window = int(args.momentum_window) if hasattr(args, "momentum_window") and args.momentum_window is not None else 10
     
     pf_nav, daily_ret, asset_val, prices, events = backtest(
-        price_map,
+        closes,
         weights,
         start_date=args.start,
         end_date=args.end,
@@ -128,19 +178,21 @@ def stage_backtest(args):
     # 报告
     report_path = generate_markdown_report(pf_nav, daily_ret)
     logger.info(f"Report saved to {report_path}")
-    from report import compute_yearly_metrics, save_yearly_metrics
     yearly_df = compute_yearly_metrics(pf_nav, daily_ret)
     yearly_path = save_yearly_metrics(yearly_df)
     logger.info(f"Yearly metrics saved to {yearly_path}")
 
     # 图表
     # 构建分资产净值（以初始1按权重分配）
-    asset_navs = {}
-    for c in prices.columns:
-        s = prices[c].pct_change().fillna(0)
-        nav = (1 + s).cumprod()
-        nav.iloc[0] = 1.0
-        asset_navs[c] = nav
+    arr = prices.to_numpy(dtype=np.float64)
+    rets = np.zeros_like(arr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rets[1:] = arr[1:] / arr[:-1] - 1.0
+    rets[np.isnan(rets)] = 0.0
+    navs = np.cumprod(1.0 + rets, axis=0)
+    navs[0, :] = 1.0
+    navs_df = pd.DataFrame(navs, index=prices.index, columns=prices.columns)
+    asset_navs = {c: navs_df[c] for c in prices.columns}
     fig = make_portfolio_figure(pf_nav, asset_navs)
     html_path = save_figure_html(fig)
     logger.info(f"Chart saved to {html_path}")
@@ -150,12 +202,38 @@ def stage_backtest(args):
     logger.info(f"Events saved to {events_path}")
 
 
+# 网格搜索结果表中的指标列（顺序即 CSV 列顺序）
+_GS_METRIC_FIELDS = ("总收益", "年化收益率", "波动率", "夏普比率", "最大回撤")
+
+# 网格搜索子进程共享的只读状态：由进程池 initializer 注入一次，避免每个任务重复传输价格数据
+_GS_STATE: Dict[str, object] = {}
+
+
+def _gridsearch_init(prices: pd.DataFrame, weights: Dict[str, float], sma_cache):
+    _GS_STATE.update(prices=prices, weights=weights, sma_cache=sma_cache)
+
+
+def _gridsearch_point(params: dict):
+    from backtest import run_backtest
+    pf_nav, daily_ret, _, _ = run_backtest(_GS_STATE["prices"], _GS_STATE["weights"], sma_cache=_GS_STATE["sma_cache"], **params)
+    return pf_nav, daily_ret
+
+
+def _run_grid(prices: pd.DataFrame, weights: Dict[str, float], sma_cache, grid: List[dict]) -> list:
+    """并行执行各参数点的回测，按 grid 顺序返回 (净值, 日收益)。"""
+    n_jobs = min(len(grid), GRIDSEARCH_MAX_WORKERS or os.cpu_count() or 1)
+    if n_jobs <= 1:
+        _gridsearch_init(prices, weights, sma_cache)
+        return [_gridsearch_point(p) for p in grid]
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_gridsearch_init, initargs=(prices, weights, sma_cache)) as pool:
+        return list(pool.map(_gridsearch_point, grid, chunksize=max(1, len(grid) // (n_jobs * 4))))
+
+
 def stage_gridsearch(args):
     logger = get_logger("stage_gridsearch")
-    price_map: Dict[str, pd.DataFrame] = {}
-    for code in [to_ts_code(c) for c in args.codes]:
-        df = load_csv_close(code)
-        price_map[code] = df
+    from backtest import prepare_prices, precompute_smas
+    from report import compute_metrics
+    closes = load_wide_closes(_resolve_codes(args))
 
     weights = {to_ts_code(k): v for k, v in ETF_WEIGHTS.items()} if args.use_default_weights else {}
     if not weights:
@@ -171,71 +249,46 @@ def stage_gridsearch(args):
 
     import os
     from config import REPORT_DIR
-    rows = []
+    # 价格宽表在整个网格内不变，只准备一次
+    prices = prepare_prices(closes, start_date=args.start, end_date=args.end)
 
     if args.strategy == "momentum":
         # 动量策略网格搜索
         mom_list = parse_list(getattr(args, "momentum_list", "3,6,9,10,12"))
-        for mw in mom_list:
-            pf_nav, daily_ret, asset_val, prices, events = backtest(
-                price_map,
-                weights,
-                start_date=args.start,
-                end_date=args.end,
-                freq=args.rebalance,
-                strategy="momentum",
-                momentum_window=mw
-            )
+        grid = [dict(freq=args.rebalance, strategy="momentum", momentum_window=mw) for mw in mom_list]
+        results = _run_grid(prices, weights, None, grid)
+        # 结果直接写入预分配的定长结构化数组，末尾一次转为 DataFrame
+        out = np.empty(len(grid), dtype=[("MomentumWindow", "i8")] + [(f, "f8") for f in _GS_METRIC_FIELDS])
+        for k, (mw, (pf_nav, daily_ret)) in enumerate(zip(mom_list, results)):
             metrics = compute_metrics(pf_nav, daily_ret)
-            rows.append({
-                "MomentumWindow": mw,
-                "总收益": metrics["总收益"],
-                "年化收益率": metrics["年化收益率"],
-                "波动率": metrics["波动率"],
-                "夏普比率": metrics["夏普比率"],
-                "最大回撤": metrics["最大回撤"],
-            })
-            logger.info(
-                f"GS MomWindow={mw} AR={metrics['年化收益率']:.2%} Sharpe={metrics['夏普比率']:.2f} MDD={metrics['最大回撤']:.2%}"
-            )
+            out[k] = (mw,) + tuple(metrics[f] for f in _GS_METRIC_FIELDS)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"GS MomWindow={mw} AR={metrics['年化收益率']:.2%} Sharpe={metrics['夏普比率']:.2f} MDD={metrics['最大回撤']:.2%}"
+                )
         out_path = os.path.join(REPORT_DIR, "gridsearch_momentum.csv")
     else:
         # T-Value 策略网格搜索
         l50 = parse_list(getattr(args, "sma50_list", "30,40,50,60"))
         l100 = parse_list(getattr(args, "sma100_list", "80,100,120"))
         l200 = parse_list(getattr(args, "sma200_list", "180,200,250"))
+        # 所有候选窗口的均线一次算好，网格内仅做数组切片
+        sma_cache = precompute_smas(prices, l50 + l100 + l200)
         
-        for w50 in l50:
-            for w100 in l100:
-                for w200 in l200:
-                    pf_nav, daily_ret, asset_val, prices, events = backtest(
-                        price_map,
-                        weights,
-                        start_date=args.start,
-                        end_date=args.end,
-                        freq=args.rebalance,
-                        strategy="tvalue",
-                        sma_short=w50,
-                        sma_mid=w100,
-                        sma_long=w200,
-                    )
-                    metrics = compute_metrics(pf_nav, daily_ret)
-                    rows.append({
-                        "SMA50": w50,
-                        "SMA100": w100,
-                        "SMA200": w200,
-                        "总收益": metrics["总收益"],
-                        "年化收益率": metrics["年化收益率"],
-                        "波动率": metrics["波动率"],
-                        "夏普比率": metrics["夏普比率"],
-                        "最大回撤": metrics["最大回撤"],
-                    })
-                    logger.info(
-                        f"GS {w50}-{w100}-{w200} AR={metrics['年化收益率']:.2%} Sharpe={metrics['夏普比率']:.2f} MDD={metrics['最大回撤']:.2%}"
-                    )
+        triples = list(itertools.product(l50, l100, l200))
+        grid = [dict(freq=args.rebalance, strategy="tvalue", sma_short=w50, sma_mid=w100, sma_long=w200) for w50, w100, w200 in triples]
+        results = _run_grid(prices, weights, sma_cache, grid)
+        out = np.empty(len(grid), dtype=[("SMA50", "i8"), ("SMA100", "i8"), ("SMA200", "i8")] + [(f, "f8") for f in _GS_METRIC_FIELDS])
+        for k, ((w50, w100, w200), (pf_nav, daily_ret)) in enumerate(zip(triples, results)):
+            metrics = compute_metrics(pf_nav, daily_ret)
+            out[k] = (w50, w100, w200) + tuple(metrics[f] for f in _GS_METRIC_FIELDS)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"GS {w50}-{w100}-{w200} AR={metrics['年化收益率']:.2%} Sharpe={metrics['夏普比率']:.2f} MDD={metrics['最大回撤']:.2%}"
+                )
         out_path = os.path.join(REPORT_DIR, "gridsearch_sma.csv")
 
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame.from_records(out)
     df.to_csv(out_path, index=False, encoding="utf-8-sig")
     logger.info(f"GridSearch saved to {out_path}")
 
@@ -259,6 +312,7 @@ def build_parser():
     parser.add_argument("--sma200_list", default="180,190,200,210,220,230,240,250")
     parser.add_argument("--momentum_window", type=int, help="绝对动量回顾窗口(月)")
     parser.add_argument("--momentum_list", default="3,6,9,10,12", help="绝对动量网格搜索窗口列表(逗号分隔)")
+    parser.add_argument("--refresh_calendar", action="store_true", help="忽略本地交易日历缓存，重新从Tushare拉取")
     return parser
 
 
@@ -267,6 +321,7 @@ def main():
     logger = get_logger("main")
     parser = build_parser()
     args = parser.parse_args()
+    args.resolved_codes = [to_ts_code(c) for c in args.codes]
 
     if args.action in ("fetch", "all"):
         stage_fetch(args)
@@ -1,44 +1,71 @@
 from typing import Dict
+import logging
 import os
 
 import numpy as np
 import pandas as pd
 
-from utils import get_logger, ensure_directories
+from utils import get_logger, ensure_directories, njit
 from config import REPORT_DIR, RISK_FREE_ANNUAL
 
 
+@njit(cache=True)
+def _metrics_kernel(nav_a, ret_a, years, rf_daily):
+    """单次遍历计算 (总收益, 年化收益率, 波动率, 夏普比率, 最大回撤)，不产生中间数组。"""
+    n = ret_a.shape[0]
+    total_return = nav_a[-1] / nav_a[0] - 1.0
+    cagr = (1.0 + total_return) ** (1.0 / max(years, 1e-8)) - 1.0
+
+    # 净值滚动最高点与最大回撤，同时累计收益率之和
+    peak = nav_a[0]
+    mdd = 0.0
+    for i in range(nav_a.shape[0]):
+        if nav_a[i] > peak:
+            peak = nav_a[i]
+        dd = nav_a[i] / peak - 1.0
+        if dd < mdd:
+            mdd = dd
+    s = 0.0
+    for i in range(n):
+        s += ret_a[i]
+    mean_daily = s / n
+    # 第二遍按离差平方和求样本标准差（ddof=1），数值上比平方和公式稳定
+    ss = 0.0
+    for i in range(n):
+        d = ret_a[i] - mean_daily
+        ss += d * d
+    std = np.sqrt(ss / (n - 1)) if n > 1 else np.nan
+    vol = std * np.sqrt(252.0)
+    sharpe = (mean_daily - rf_daily) / (std + 1e-12) * np.sqrt(252.0)
+    return total_return, cagr, vol, sharpe, mdd
+
+
 def compute_metrics(nav: pd.Series, daily_ret: pd.Series, risk_free_annual: float = RISK_FREE_ANNUAL) -> Dict[str, float]:
     logger = get_logger("report")
     if nav.empty:
         raise ValueError("NAV series is empty")
     start, end = nav.index.min(), nav.index.max()
-    total_return = float(nav.iloc[-1] / nav.iloc[0] - 1.0)
+    # 一次性转为 ndarray，交由单遍内核计算
+    nav_a = nav.to_numpy(dtype=np.float64)
+    ret_a = daily_ret.to_numpy(dtype=np.float64)
     years = (end - start).days / 365.25
-    cagr = (1.0 + total_return) ** (1.0 / max(years, 1e-8)) - 1.0
-
-    vol = float(np.std(daily_ret, ddof=1) * np.sqrt(252))
-    mean_daily = float(np.mean(daily_ret))
     rf_daily = (1.0 + risk_free_annual) ** (1.0 / 252.0) - 1.0
-    sharpe = (mean_daily - rf_daily) / (np.std(daily_ret, ddof=1) + 1e-12) * np.sqrt(252)
-
-    cummax = nav.cummax()
-    drawdown = nav / cummax - 1.0
-    mdd = float(drawdown.min())
+    total_return, cagr, vol, sharpe, mdd = _metrics_kernel(nav_a, ret_a, years, rf_daily)
 
     metrics = {
         "开始日期": str(start.date()),
         "结束日期": str(end.date()),
-        "总收益": total_return,
-        "年化收益率": cagr,
-        "波动率": vol,
-        "夏普比率": sharpe,
-        "最大回撤": mdd,
+        "总收益": float(total_return),
+        "年化收益率": float(cagr),
+        "波动率": float(vol),
+        "夏普比率": float(sharpe),
+        "最大回撤": float(mdd),
         "样本交易日数": int(len(daily_ret)),
     }
-    logger.info(
-        f"Metrics: AR={metrics['年化收益率']:.2%}, Vol={metrics['波动率']:.2%}, Sharpe={metrics['夏普比率']:.2f}, MDD={metrics['最大回撤']:.2%}"
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            f"Metrics: AR={metrics['年化收益率']:.2%}, Vol={metrics['波动率']:.2%}, Sharpe={metrics['夏普比率']:.2f}, MDD={metrics['最大回撤']:.2%}"
+        )
     return metrics
 
 
@@ -68,12 +95,10 @@ def generate_markdown_report(nav: pd.Series, daily_ret: pd.Series, out_name: str
 
 def save_holdings_csv(asset_values: pd.DataFrame, capital: float = 1.0, out_name: str = "holdings_daily.csv") -> str:
     ensure_directories()
-    df = asset_values.copy()
-    df = df.sort_index()
-    df = df * float(capital)
-    df.insert(0, "date", df.index)
+    # 回测输出已按日期升序，仅在乱序时排序；日期索引直接作为 date 列写出，不再额外拷贝/插列
+    df = asset_values if asset_values.index.is_monotonic_increasing else asset_values.sort_index()
     out_path = os.path.join(REPORT_DIR, out_name)
-    df.to_csv(out_path, index=False, encoding="utf-8-sig")
+    df.mul(float(capital)).to_csv(out_path, index_label="date", encoding="utf-8-sig")
     return out_path
 
 
@@ -81,8 +106,8 @@ def save_events_csv(events_df: pd.DataFrame, out_name: str = "rebalance_events.c
     ensure_directories()
     if events_df is None or events_df.empty or (isinstance(events_df, pd.DataFrame) and 'date' not in events_df.columns):
         return ""
-    df = events_df.copy()
-    df = df.sort_values("date")
+    # sort_values 本身返回新对象，无需先拷贝；同日多条事件用稳定排序保持生成顺序，已有序则直接写出
+    df = events_df if events_df["date"].is_monotonic_increasing else events_df.sort_values("date", kind="mergesort")
     out_path = os.path.join(REPORT_DIR, out_name)
     df.to_csv(out_path, index=False, encoding="utf-8-sig")
     return out_path
@@ -1,7 +1,11 @@
 import os
+import atexit
+from functools import lru_cache
 import logging
-from logging.handlers import RotatingFileHandler
-from typing import Optional
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from typing import Callable, Optional
+import threading
 import time
 import random
 
@@ -9,36 +13,80 @@ import pandas as pd
 
 from config import LOG_DIR, DATA_DIR, CHART_DIR, REPORT_DIR
 
+def njit(*args, **kwargs):
+    """numba.njit 的惰性封装：首次装饰数值内核时才导入 numba。"""
+    try:
+        from numba import njit as _numba_njit
+    except Exception:  # numba 为可选依赖；缺失时数值内核按纯 Python 执行
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+    return _numba_njit(*args, **kwargs)
+
 
 def ensure_directories():
     for d in (LOG_DIR, DATA_DIR, CHART_DIR, REPORT_DIR):
         os.makedirs(d, exist_ok=True)
 
 
-def get_logger(name: str = "app", level: int = logging.INFO) -> logging.Logger:
-    ensure_directories()
-    logger = logging.getLogger(name)
-    if logger.handlers:
-        return logger
-    logger.setLevel(level)
+# 所有 logger 共用一个 QueueHandler：调用方只负责入队，格式化与控制台/文件写入由后台监听线程完成
+_QUEUE_HANDLER: Optional[QueueHandler] = None
+_LOG_LISTENER: Optional[QueueListener] = None
+
+
+def _start_log_listener(handlers) -> None:
+    global _LOG_LISTENER
+    _QUEUE_HANDLER.queue = queue.Queue(-1)
+    _LOG_LISTENER = QueueListener(_QUEUE_HANDLER.queue, *handlers)
+    _LOG_LISTENER.start()
+
+
+def _restart_log_listener_in_child() -> None:
+    # fork 出的子进程不继承监听线程，需在新队列上重新启动，否则子进程日志会滞留在队列中
+    if _LOG_LISTENER is not None:
+        _start_log_listener(_LOG_LISTENER.handlers)
+
+
+def _stop_log_listener() -> None:
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+
+
+def _get_queue_handler() -> QueueHandler:
+    global _QUEUE_HANDLER
+    if _QUEUE_HANDLER is not None:
+        return _QUEUE_HANDLER
 
     # Console handler
     ch = logging.StreamHandler()
-    ch.setLevel(level)
     ch_fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
     ch.setFormatter(ch_fmt)
 
     # Rotating file handler
     fh = RotatingFileHandler(os.path.join(LOG_DIR, "app.log"), maxBytes=2 * 1024 * 1024, backupCount=3, encoding="utf-8")
-    fh.setLevel(level)
     fh_fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
     fh.setFormatter(fh_fmt)
 
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    _QUEUE_HANDLER = QueueHandler(queue.Queue(-1))
+    _start_log_listener((ch, fh))
+    # 退出时停止监听线程，确保队列中剩余日志全部写出
+    atexit.register(_stop_log_listener)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart_log_listener_in_child)
+    return _QUEUE_HANDLER
+
+
+def get_logger(name: str = "app", level: int = logging.INFO) -> logging.Logger:
+    ensure_directories()
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    logger.setLevel(level)
+    logger.addHandler(_get_queue_handler())
     return logger
 
 
+@lru_cache(maxsize=256)
 def to_ts_code(code: str) -> str:
     """为常见沪市ETF代码补后缀；如已含后缀则原样返回。"""
     code = code.strip()
@@ -57,25 +105,47 @@ def sleep_with_log(seconds: float, logger: Optional[logging.Logger] = None):
     time.sleep(seconds)
 
 
-def sleep_random_with_log(min_seconds: float, max_seconds: float, logger: Optional[logging.Logger] = None) -> float:
-    """在[min_seconds, max_seconds]之间随机等待并记录。返回实际等待秒数。"""
+def make_request_pacer(min_seconds: float, max_seconds: float, logger: Optional[logging.Logger] = None) -> Callable[[], float]:
+    """返回线程安全的请求节流函数：相邻两次放行时刻（单调时钟）至少相隔[min_seconds, max_seconds]内的随机间隔。
+    多线程共用时请求发起频率与串行随机等待相同，但各请求的网络耗时可以相互重叠。返回本次实际等待秒数。
+    """
     a = max(0.0, float(min_seconds))
     b = max(a, float(max_seconds))
-    delay = random.uniform(a, b)
-    if logger:
-        logger.debug(f"Rate-limit random sleep {delay:.2f}s (range {a}-{b})...")
-    time.sleep(delay)
-    return delay
-
-
-def align_to_trading_days(df: pd.DataFrame, date_col: str = "trade_date") -> pd.DataFrame:
-    """确保trade_date为升序日期索引，并去重。"""
-    out = df.copy()
-    if date_col in out.columns:
+    lock = threading.Lock()
+    next_at = time.monotonic()
+
+    def wait() -> float:
+        nonlocal next_at
+        # 锁内只预约放行时刻，睡眠在锁外进行
+        with lock:
+            now = time.monotonic()
+            start = max(now, next_at)
+            next_at = start + random.uniform(a, b)
+        delay = start - now
+        if delay > 0:
+            if logger:
+                logger.debug(f"Rate-limit pacing {delay:.2f}s (range {a}-{b})...")
+            time.sleep(delay)
+        return delay
+
+    return wait
+
+
+def align_to_trading_days(df: pd.DataFrame, date_col: str = "trade_date", copy: bool = False) -> pd.DataFrame:
+    """确保trade_date为升序日期索引，并去重。
+
+    已是升序 DatetimeIndex 的输入直接返回（copy=True 时返回副本），不再重复转换与排序。
+    """
+    if date_col in df.columns:
+        # 浅拷贝即可：仅整列替换日期列，不会改写调用方的数据
+        out = df.copy(deep=copy)
         out[date_col] = pd.to_datetime(out[date_col])
         out = out.sort_values(date_col).drop_duplicates(subset=[date_col])
         out = out.set_index(date_col)
+    elif isinstance(df.index, pd.DatetimeIndex) and df.index.is_monotonic_increasing:
+        return df.copy() if copy else df
     else:
+        out = df.copy()
         out.index = pd.to_datetime(out.index)
         out = out.sort_index()
-    return out
\ No newline at end of file
+    return out
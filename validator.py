@@ -1,28 +1,49 @@
 from typing import Tuple, Optional
+from functools import lru_cache
 import logging
+import os
 
 import numpy as np
 import pandas as pd
 
 from utils import get_logger, align_to_trading_days
-from config import MAX_ABS_DAILY_RETURN, MAD_THRESHOLD
+from config import MAX_ABS_DAILY_RETURN, MAD_THRESHOLD, DATA_DIR
 
+# 交易日历磁盘缓存目录：按 (交易所, 起, 止) 各存一份
+CALENDAR_CACHE_DIR = os.path.join(DATA_DIR, ".cal_cache")
 
-def _trade_calendar(pro, start_ymd: str, end_ymd: str, exchange: str = "SSE") -> pd.DatetimeIndex:
+
+@lru_cache(maxsize=8)
+def _trade_calendar(pro, start_ymd: str, end_ymd: str, exchange: str = "SSE", refresh: bool = False) -> pd.DatetimeIndex:
+    """开市日历。依次命中进程内缓存、磁盘缓存，均未命中才请求 trade_cal；refresh=True 时忽略磁盘缓存重新拉取。"""
+    path = os.path.join(CALENDAR_CACHE_DIR, f"{exchange}_{start_ymd}_{end_ymd}.pkl")
+    if not refresh and os.path.exists(path):
+        try:
+            return pd.read_pickle(path)
+        except Exception:
+            pass
     cal = pro.trade_cal(exchange=exchange, start_date=start_ymd, end_date=end_ymd)
     cal = cal[cal["is_open"] == 1]["cal_date"]
-    idx = pd.to_datetime(cal)
-    return pd.DatetimeIndex(idx)
+    idx = pd.DatetimeIndex(pd.to_datetime(cal))
+    os.makedirs(CALENDAR_CACHE_DIR, exist_ok=True)
+    pd.to_pickle(idx, path)
+    return idx
 
 
-def check_completeness(df: pd.DataFrame, pro, start_date: str, end_date: str, logger: Optional[logging.Logger] = None) -> Tuple[bool, pd.DataFrame]:
+def check_completeness(df: pd.DataFrame, pro, start_date: str, end_date: str, logger: Optional[logging.Logger] = None, pre_aligned: bool = False, refresh_calendar: bool = False) -> Tuple[bool, pd.DataFrame]:
     logger = logger or get_logger("validate")
-    # df 已是按交易日索引
-    df = align_to_trading_days(df)
+    # pre_aligned=True 表示 df 已按交易日索引，跳过重复对齐
+    if not pre_aligned:
+        df = align_to_trading_days(df)
     start_ymd = pd.to_datetime(start_date).strftime("%Y%m%d")
     end_ymd = pd.to_datetime(end_date).strftime("%Y%m%d")
-    cal_idx = _trade_calendar(pro, start_ymd, end_ymd)
-    missing = cal_idx.difference(df.index)
+    cal_idx = _trade_calendar(pro, start_ymd, end_ymd, refresh=refresh_calendar)
+    # df.index 已升序：对每个开市日二分查找是否存在，无需像 Index.difference 那样哈希/重排两侧
+    cal = cal_idx.values
+    have = df.index.values
+    pos = np.searchsorted(have, cal)
+    found = have[np.minimum(pos, len(have) - 1)] == cal if len(have) else np.zeros(len(cal), dtype=bool)
+    missing = pd.DatetimeIndex(np.sort(cal[~found]))
     ok = len(missing) == 0
     if not ok:
         logger.warning(f"Missing {len(missing)} open days. Example: {list(missing[:5])}")
@@ -31,24 +52,28 @@ def check_completeness(df: pd.DataFrame, pro, start_date: str, end_date: str, lo
     return ok, pd.DataFrame({"missing_date": missing})
 
 
-def detect_anomalies(df: pd.DataFrame, logger: Optional[logging.Logger] = None) -> pd.DataFrame:
+def detect_anomalies(df: pd.DataFrame, logger: Optional[logging.Logger] = None, pre_aligned: bool = False) -> pd.DataFrame:
     logger = logger or get_logger("validate")
-    df = align_to_trading_days(df)
-    close = df["close" if "close" in df.columns else "收盘价"].astype(float)
-    ret = close.pct_change()
-
-    # 基于绝对阈值
-    flag1 = ret.abs() > MAX_ABS_DAILY_RETURN
-
-    # 基于MAD鲁棒检测
+    if not pre_aligned:
+        df = align_to_trading_days(df)
+    c = df["close" if "close" in df.columns else "收盘价"].to_numpy(dtype=np.float64)
+    # 与 pct_change 默认口径一致：缺失价格先前向填充
+    nan_mask = np.isnan(c)
+    if nan_mask.any():
+        c = c[np.maximum.accumulate(np.where(nan_mask, 0, np.arange(len(c))))]
+    ret = np.empty_like(c)
+    ret[:1] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret[1:] = c[1:] / c[:-1] - 1.0
+
+    # 绝对阈值与 MAD 鲁棒检测合并为一个掩码
     med = np.nanmedian(ret)
-    mad = np.nanmedian(np.abs(ret - med))
-    robust_z = np.abs((ret - med) / (mad + 1e-8))
-    flag2 = robust_z > MAD_THRESHOLD
+    abs_dev = np.abs(ret - med)
+    robust_z = abs_dev / (np.nanmedian(abs_dev) + 1e-8)
+    flags = (np.abs(ret) > MAX_ABS_DAILY_RETURN) | (robust_z > MAD_THRESHOLD)
+    idx = np.flatnonzero(flags)
 
-    flagged = df.loc[flag1 | flag2].copy()
-    flagged["daily_return"] = ret[flag1 | flag2]
-    flagged["robust_z"] = robust_z[flag1 | flag2]
+    flagged = df.iloc[idx].assign(daily_return=ret[idx], robust_z=robust_z[idx])
     if not flagged.empty:
         logger.warning(f"Detected {len(flagged)} potential anomalies")
     else:
@@ -56,9 +81,10 @@ def detect_anomalies(df: pd.DataFrame, logger: Optional[logging.Logger] = None)
     return flagged
 
 
-def cross_validate_with_akshare(ts_code: str, df_ts: pd.DataFrame, start_date: str, end_date: str, logger: Optional[logging.Logger] = None) -> Tuple[bool, Optional[pd.DataFrame]]:
+def cross_validate_with_akshare(ts_code: str, df_ts: pd.DataFrame, start_date: str, end_date: str, logger: Optional[logging.Logger] = None, pre_aligned: bool = False) -> Tuple[bool, Optional[pd.DataFrame]]:
     """使用AkShare的东财ETF数据进行交叉验证。
     可能因环境未安装或网络错误而失败，失败时返回(False, None)。
+    pre_aligned=True 表示 df_ts 已按交易日索引。
     """
     logger = logger or get_logger("validate")
     try:
@@ -84,8 +110,8 @@ def cross_validate_with_akshare(ts_code: str, df_ts: pd.DataFrame, start_date: s
     ak_df = align_to_trading_days(ak_df)
 
     # 对齐合并
-    ts_df = df_ts[["close"]].copy()
-    ts_df = align_to_trading_days(ts_df)
+    # 先对齐再取列：日期可能仍在列中，先取列会丢失日期
+    ts_df = (df_ts if pre_aligned else align_to_trading_days(df_ts))[["close"]]
     merged = ts_df.join(ak_df, how="inner", lsuffix="_ts", rsuffix="_ak")
     if merged.empty:
         logger.warning("No overlapping dates for cross validation")
@@ -1,10 +1,11 @@
 from typing import Dict, Optional
 import os
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
-from utils import get_logger, ensure_directories
+from utils import get_logger, ensure_directories, njit
 from config import CHART_DIR
 from backtest import max_drawdown
 
@@ -15,21 +16,69 @@ def _cum_from_returns(ret: pd.Series) -> pd.Series:
     return nav
 
 
-def make_portfolio_figure(portfolio_nav: pd.Series, asset_navs: Optional[Dict[str, pd.Series]] = None, title: str = "组合净值与最大回撤") -> go.Figure:
+@njit(cache=True)
+def _lttb_indices(y, n_out):
+    """Largest-Triangle-Three-Buckets 降采样，返回保留点的位置（横轴取序号）。
+    每个桶保留与前一保留点、下一桶均值构成三角形面积最大的点，保留曲线形状与极值。
+    """
+    n = y.shape[0]
+    out = np.empty(n_out, dtype=np.int64)
+    out[0] = 0
+    out[n_out - 1] = n - 1
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        # 下一个桶的均值点
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = 0.0
+        avg_y = 0.0
+        for j in range(avg_start, avg_end):
+            avg_x += j
+            avg_y += y[j]
+        cnt = avg_end - avg_start
+        avg_x /= cnt
+        avg_y /= cnt
+
+        # 当前桶内选面积最大的点
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        best = start
+        best_area = -1.0
+        for j in range(start, end):
+            area = abs((a - avg_x) * (y[j] - y[a]) - (a - j) * (avg_y - y[a]))
+            if area > best_area:
+                best_area = area
+                best = j
+        out[i + 1] = best
+        a = best
+    return out
+
+
+def _downsample(s: pd.Series, max_points: int = 2000) -> pd.Series:
+    """点数超过 max_points 时按 LTTB 降采样，常见缩放下与原曲线视觉一致。"""
+    if max_points < 3 or len(s) <= max_points:
+        return s
+    return s.iloc[_lttb_indices(s.to_numpy(dtype=np.float64), int(max_points))]
+
+
+def make_portfolio_figure(portfolio_nav: pd.Series, asset_navs: Optional[Dict[str, pd.Series]] = None, title: str = "组合净值与最大回撤", max_points: int = 2000) -> go.Figure:
     logger = get_logger("viz")
     fig = go.Figure()
-    # 组合
-    fig.add_trace(go.Scatter(x=portfolio_nav.index, y=portfolio_nav.values, name="组合净值", mode="lines", line=dict(width=2)))
+    mdd, peak_date, trough_date, peak_val, trough_val = max_drawdown(portfolio_nav)
+    # 组合（保证回撤峰/谷点留在降采样曲线上，使标注落在线上）
+    pf = _downsample(portfolio_nav, max_points)
+    if len(pf) < len(portfolio_nav):
+        pf = portfolio_nav.loc[pf.index.union([peak_date, trough_date])]
+    fig.add_trace(go.Scatter(x=pf.index, y=pf.values, name="组合净值", mode="lines", line=dict(width=2)))
 
     # 子资产
     if asset_navs:
         for name, s in asset_navs.items():
+            s = _downsample(s, max_points)
             fig.add_trace(go.Scatter(x=s.index, y=s.values, name=name, mode="lines", line=dict(width=1, dash="dot")))
 
-    # 最大回撤标注
-    mdd, peak_date, trough_date = max_drawdown(portfolio_nav)
-    peak_val = float(portfolio_nav.loc[peak_date])
-    trough_val = float(portfolio_nav.loc[trough_date])
+    # 最大回撤标注（基于完整序列，不受降采样影响）
     fig.add_trace(
         go.Scatter(
             x=[peak_date, trough_date],
@@ -43,7 +92,7 @@ def make_portfolio_figure(portfolio_nav: pd.Series, asset_navs: Optional[Dict[st
 
     fig.update_layout(
         title=title,
-        xaxis=dict(rangeslider=dict(visible=True), type="date"),
+        xaxis=dict(rangeslider=dict(visible=False), type="date"),
         yaxis_title="净值",
         template="plotly_white",
         legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
@@ -55,5 +104,5 @@ def make_portfolio_figure(portfolio_nav: pd.Series, asset_navs: Optional[Dict[st
 def save_figure_html(fig: go.Figure, out_name: str = "portfolio.html") -> str:
     ensure_directories()
     out_path = os.path.join(CHART_DIR, out_name)
-    fig.write_html(out_path, include_plotlyjs="cdn")
+    fig.write_html(out_path, include_plotlyjs="cdn", full_html=True, config={"responsive": True})
     return out_path
\ No newline at end of file